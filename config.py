@@ -20,13 +20,16 @@ config_dict = {
     # Model
     'train': True,
     'size': 5,  # 5 / 10 / 28
-    'model_name': "long",  # simple / vardeq / long / linear / partial_conv / multiscale
+    'model_name': "long",  # simple / vardeq / long / linear / conv1x1 / partial_conv / multiscale
     'epochs': 5,  # 5 / 200
+    'amp': True,  # bf16 mixed precision (autocast) for training and sampling
+    'compile': False,  # torch.compile the coupling networks (long start-up, faster steps)
 
     # Sample
     'num_samples': 64,
     'save_samples': True,
-    'show_samples': False
+    'show_samples': False,
+    'sample_cuda_graph': False  # replay the sampling pass as a CUDA graph (cuda only, pays off for repeated sampling)
 }
 
 
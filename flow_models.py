@@ -12,14 +12,21 @@ class CouplingLayer(nn.Module):
                       Output shape should be twice the channel size as the input.
             mask - Binary mask (0 or 1) where 0 denotes that the element should be transformed,
                    while 1 means the latent will be used as input to the NN.
+                   For channel masks only the unmasked channels are passed to the network,
+                   which should then take mask.sum() input channels.
             c_in - Number of input channels
         """
         super().__init__()
         self.network = network
         self.scaling_factor = nn.Parameter(torch.zeros(c_in))
-        # Register mask as buffer as it is a tensor which is not a parameter,
-        # but should be part of the modules state.
-        self.register_buffer('mask', mask)
+        # Register mask as buffer as it is a tensor which is not a parameter, but should follow the module's device.
+        # It is rebuilt with the model, so it is not saved in checkpoints.
+        self.register_buffer('mask', mask, persistent=False)
+        # A channel mask keeps one contiguous block of channels, stored as (start, length) for narrow
+        self.active_channels = None
+        if mask.shape[2:] == (1, 1) and mask.shape[1] > 1:
+            active = mask.view(-1).nonzero().view(-1)
+            self.active_channels = (int(active[0]), active.numel())
 
     def forward(self, z, ldj, reverse=False, orig_img=None):
         """
@@ -31,13 +38,17 @@ class CouplingLayer(nn.Module):
             orig_img (optional) - Only needed in VarDeq. Allows external
                                   input to condition the flow on (e.g. original image)
         """
-        # Apply network to masked input
-        z_in = z * self.mask
+        # Apply network to masked input (slicing out the unmasked channels skips the zeroed half)
+        if self.active_channels is None:
+            z_in = z * self.mask
+        else:
+            z_in = z.narrow(1, *self.active_channels)
         if orig_img is None:
             nn_out = self.network(z_in)
         else:
             nn_out = self.network(torch.cat([z_in, orig_img], dim=1))
-        s, t = nn_out.chunk(2, dim=1)
+        # The network may run in bf16 under autocast, the affine transform and its ldj are kept in fp32
+        s, t = nn_out.float().chunk(2, dim=1)
 
         # Stabilize scaling output
         s_fac = self.scaling_factor.exp().view(1, -1, 1, 1)
@@ -82,14 +93,16 @@ class SplitFlow(nn.Module):
     def __init__(self, config):
         super().__init__()
         self.config = config
-        self.prior = torch.distributions.normal.Normal(loc=0.0, scale=1.0)
+        # No argument validation: its support check syncs with the host, which a CUDA graph capture does not allow
+        self.prior = torch.distributions.normal.Normal(loc=0.0, scale=1.0, validate_args=False)
 
     def forward(self, z, ldj, reverse=False):
         if not reverse:
             z, z_split = z.chunk(2, dim=1)
             ldj += self.prior.log_prob(z_split).sum(dim=[1, 2, 3])
         else:
-            z_split = self.prior.sample(sample_shape=z.shape).to(self.config.device)
+            # Sampled directly on z's device (standard normal, same as self.prior) so it can be captured in a CUDA graph
+            z_split = torch.randn_like(z)
             z = torch.cat([z, z_split], dim=1)
             ldj -= self.prior.log_prob(z_split).sum(dim=[1, 2, 3])
         return z, ldj
@@ -1,8 +1,10 @@
+import itertools
 import numpy as np
 import torch
 import torch.nn as nn
 import torch.optim as optim
 import pytorch_lightning as pl
+from flow_models import CouplingLayer
 from tools import regular_tensor
 
 
@@ -21,6 +23,55 @@ class ImageFlow(pl.LightningModule):
         self.import_samples = import_samples
         # Create prior distribution for final latent space
         self.prior = torch.distributions.normal.Normal(loc=0.0, scale=1.0)
+        # CUDA graphs of the sampling pass, keyed by latent shape, captured for the tensors in _sample_graphs_ptrs
+        # (see _decode_graphed)
+        self._sample_graphs = {}
+        self._sample_graphs_ptrs = None
+        # All distinct coupling masks as one flat tensor, the masks are views of it (see _apply)
+        self._flat_masks = None
+
+    def _apply(self, fn, *args, **kwargs):
+        """
+        Coupling layers built with the same (cached, see tools.py) mask share one buffer. nn.Module._apply would
+        convert it once per layer and untie it on every .to()/.cpu(), so the masks are taken out and put back shared.
+        All distinct masks are converted together as one flat tensor (pinned when on the host), i.e. a single copy
+        per move, and come back as views of it.
+        """
+        layers_by_mask = {}
+        for module in self.modules():
+            if isinstance(module, CouplingLayer):
+                layers_by_mask.setdefault(id(module.mask), []).append(module)
+        masks = [layers[0].mask for layers in layers_by_mask.values()]
+        for layers in layers_by_mask.values():
+            for layer in layers:
+                layer._buffers['mask'] = None  # skipped by nn.Module._apply
+        try:
+            super()._apply(fn, *args, **kwargs)
+            if masks:
+                masks = self._apply_masks(fn, masks)
+        finally:
+            for layers, mask in zip(layers_by_mask.values(), masks):
+                for layer in layers:
+                    layer._buffers['mask'] = mask
+        return self
+
+    def _apply_masks(self, fn, masks):
+        # Apply fn once to all masks as one flat tensor and return views of the result with the masks' shapes.
+        # The flat tensor is kept, so when the masks are already its views a no-op move (e.g. the .to() in sample)
+        # keeps the very same tensors, and the CUDA graphs captured for them stay cached (see _decode_graphed).
+        if self._flat_masks is not None and all(mask._base is self._flat_masks for mask in masks):
+            flat = self._flat_masks
+        else:
+            pin = masks[0].device.type == 'cpu' and torch.cuda.is_available()
+            flat = torch.empty(sum(mask.numel() for mask in masks), dtype=masks[0].dtype, device=masks[0].device,
+                               pin_memory=pin)
+            torch.cat([mask.flatten() for mask in masks], out=flat)
+        moved = fn(flat)
+        if moved is flat and flat is self._flat_masks:
+            return masks
+        masks = [chunk.view(mask.shape) for mask, chunk in zip(masks, moved.split([mask.numel() for mask in masks]))]
+        self._flat_masks = moved
+        return masks
 
     def forward(self, imgs):
         # The forward function is only used for visualizing the graph
@@ -61,14 +112,57 @@ class ImageFlow(pl.LightningModule):
             z = z_init.to(self.config.device)
 
         # Transform z to x by inverting the flows
-        ldj = torch.zeros(sample_shape[0], device=self.config.device)
         self.to(self.config.device)  # sample is not called by pl.trainer, so device should be handled manually.
+        device_type = torch.device(self.config.device).type
+        # Same mixed precision as in training (the trainer handles autocast there); no weight cache for CUDA graphs
+        with torch.autocast(device_type=device_type, dtype=torch.bfloat16,
+                            enabled=self.config.amp, cache_enabled=False):
+            if self.config.sample_cuda_graph and device_type == 'cuda':
+                z = self._decode_graphed(z)
+                assert regular_tensor(z)  # no nan/inf/extreme_float
+            else:
+                z = self._decode(z)
+        return z
+
+    def _decode(self, z, check=True):
+        ldj = torch.zeros(z.shape[0], device=self.config.device)
         for flow in reversed(self.flows):
-            assert self.device == torch.device(self.config.device)  # stays on GPU
+            if check:
+                assert self.device == torch.device(self.config.device)  # stays on GPU
             z, ldj = flow(z, ldj, reverse=True)
-            assert (regular_tensor(z) and regular_tensor(ldj))  # no nan/inf/extreme_float
+            if check:
+                assert (regular_tensor(z) and regular_tensor(ldj))  # no nan/inf/extreme_float
         return z
 
+    def _decode_graphed(self, z):
+        """
+        Run _decode as a CUDA graph, captured once per latent shape and replayed on later calls.
+        A graph replays against the memory of the parameters and buffers it was captured with: in-place updates
+        (optimizer steps, load_state_dict) are picked up, but moving the module (e.g. Lightning's teardown to CPU and
+        the .to() in sample) replaces that memory, so the graphs are dropped whenever the data pointers change.
+        """
+        ptrs = tuple(t.data_ptr() for t in itertools.chain(self.parameters(), self.buffers()))
+        if ptrs != self._sample_graphs_ptrs:
+            self._sample_graphs = {}
+            self._sample_graphs_ptrs = ptrs
+        if z.shape not in self._sample_graphs:
+            static_z = z.clone()
+            # Warmup (with the usual checks) on a side stream before capturing
+            stream = torch.cuda.Stream()
+            stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(stream):
+                self._decode(static_z)
+            torch.cuda.current_stream().wait_stream(stream)
+            graph = torch.cuda.CUDAGraph()
+            with torch.cuda.graph(graph):
+                static_out = self._decode(static_z, check=False)
+            self._sample_graphs[z.shape] = (graph, static_z, static_out)
+
+        graph, static_z, static_out = self._sample_graphs[z.shape]
+        static_z.copy_(z)
+        graph.replay()
+        return static_out.clone()
+
     def configure_optimizers(self):
         optimizer = optim.Adam(self.parameters(), lr=1e-3)
         # An scheduler is optional, but can help in flows to get the last bpd improvement
@@ -2,34 +2,64 @@ import torch
 from flow_template import ImageFlow
 from flow_dequantization import Dequantization, VariationalDequantization
 from flow_models import CouplingLayer, SqueezeFlow, SplitFlow
-from nn_layers import GatedConvNet, GatedLinearNet
+from nn_layers import GatedConvNet, GatedLinearNet, GatedConv1x1Net
 from tools import create_checkerboard_mask, create_channel_mask
 
 
-def get_flow_layers(size, c, vardeq=True, num_layers=8, linear=False, partial_conv=False):
+def make_vardeq_layers(c, size, c_hidden=16, partial_conv=False):
+    """
+    4 * CouplingLayer(GatedConvNet) modeling q(u|x) of VariationalDequantization (conditioned on the original image)
+    """
+    return [CouplingLayer(network=GatedConvNet(c_in=2*c, c_out=2*c, c_hidden=c_hidden, partial_conv=partial_conv),
+                          mask=create_checkerboard_mask(h=size, w=size, invert=(i % 2 == 1)),
+                          c_in=1*c) for i in range(4)]
+
+
+def make_coupling_stack(c_in, c_hidden, n, size=None, partial_conv=False):
+    """
+    n * CouplingLayer(GatedConvNet) with alternating masks.
+    Checkerboard masks of size x size are used if size is given, channel masks otherwise.
+    With channel masks the network only takes the unmasked channels as input (see CouplingLayer).
+    """
+    coupling_layers = []
+    for i in range(n):
+        if size is not None:
+            mask = create_checkerboard_mask(h=size, w=size, invert=(i % 2 == 1))
+            c_net = c_in
+        else:
+            mask = create_channel_mask(c_in=c_in, invert=(i % 2 == 1))
+            c_net = int(mask.sum())
+        coupling_layers += [CouplingLayer(network=GatedConvNet(c_in=c_net, c_out=2*c_in, c_hidden=c_hidden,
+                                                               partial_conv=partial_conv),
+                                          mask=mask,
+                                          c_in=c_in)]
+    return coupling_layers
+
+
+def get_flow_layers(size, c, vardeq=True, num_layers=8, linear=False, partial_conv=False, conv1x1=False):
     flow_layers = []
 
     # Dequantization
     if vardeq:
-        vardeq_layers = [CouplingLayer(network=GatedConvNet(c_in=2 * c, c_out=2 * c, c_hidden=16, partial_conv=partial_conv),
-                                       mask=create_checkerboard_mask(h=size, w=size, invert=(i % 2 == 1)),
-                                       c_in=1 * c) for i in range(4)]
-        flow_layers += [VariationalDequantization(var_flows=vardeq_layers)]
+        flow_layers += [VariationalDequantization(var_flows=make_vardeq_layers(c, size, partial_conv=partial_conv))]
     else:
         flow_layers += [Dequantization()]
 
     # Main Flow
-    for i in range(num_layers):
-        if not linear:
-            flow_layers += [CouplingLayer(network=GatedConvNet(c_in=1*c, c_hidden=32, partial_conv=partial_conv),
-                                          mask=create_checkerboard_mask(h=size, w=size, invert=(i % 2 == 1)),
-                                          c_in=1*c)]
-        else:
-            num_features = c * size * size
-            flow_layers += [CouplingLayer(network=GatedLinearNet(in_features=num_features),
-                                          mask=create_checkerboard_mask(h=size, w=size,
-                                                                        invert=(i % 2 == 1)),
-                                          c_in=1*c)]
+    if not (linear or conv1x1):
+        flow_layers += make_coupling_stack(c_in=1*c, c_hidden=32, n=num_layers, size=size, partial_conv=partial_conv)
+    else:
+        for i in range(num_layers):
+            if conv1x1:
+                flow_layers += [CouplingLayer(network=GatedConv1x1Net(c_in=1*c, c_hidden=32),
+                                              mask=create_checkerboard_mask(h=size, w=size, invert=(i % 2 == 1)),
+                                              c_in=1*c)]
+            else:
+                num_features = c * size * size
+                flow_layers += [CouplingLayer(network=GatedLinearNet(in_features=num_features),
+                                              mask=create_checkerboard_mask(h=size, w=size,
+                                                                            invert=(i % 2 == 1)),
+                                              c_in=1*c)]
 
     return flow_layers
 
@@ -40,7 +70,7 @@ def create_simple_flow(config):
     """
     flow_layers = get_flow_layers(config.size, config.c, vardeq=False, num_layers=8, linear=False, partial_conv=False)
     flow_model = ImageFlow(flow_layers, config=config)
-    sample_shape_factor = torch.tensor([1, 1, 1, 1])
+    sample_shape_factor = (1, 1, 1, 1)
     return flow_model, sample_shape_factor
 
 
@@ -51,7 +81,7 @@ def create_vardeq_flow(config):
     flow_layers = get_flow_layers(config.size, config.c, vardeq=True, num_layers=8, linear=False, partial_conv=False)
 
     flow_model = ImageFlow(flow_layers, config=config)
-    sample_shape_factor = torch.tensor([1, 1, 1, 1])
+    sample_shape_factor = (1, 1, 1, 1)
     return flow_model, sample_shape_factor
 
 
@@ -62,7 +92,7 @@ def create_long_flow(config):
     flow_layers = get_flow_layers(config.size, config.c, vardeq=True, num_layers=15, linear=False, partial_conv=False)
 
     flow_model = ImageFlow(flow_layers, config=config)
-    sample_shape_factor = torch.tensor([1, 1, 1, 1])
+    sample_shape_factor = (1, 1, 1, 1)
     return flow_model, sample_shape_factor
 
 
@@ -73,7 +103,19 @@ def create_linear_flow(config):
     flow_layers = get_flow_layers(config.size, config.c, vardeq=True, num_layers=8, linear=True, partial_conv=False)
 
     flow_model = ImageFlow(flow_layers, config=config)
-    sample_shape_factor = torch.tensor([1, 1, 1, 1])
+    sample_shape_factor = (1, 1, 1, 1)
+    return flow_model, sample_shape_factor
+
+
+def create_conv1x1_flow(config):
+    """
+    Variational Dequantization + 8 * CouplingLayer(GatedConv1x1Net)
+    """
+    flow_layers = get_flow_layers(config.size, config.c, vardeq=True, num_layers=8, linear=False, partial_conv=False,
+                                  conv1x1=True)
+
+    flow_model = ImageFlow(flow_layers, config=config)
+    sample_shape_factor = (1, 1, 1, 1)
     return flow_model, sample_shape_factor
 
 
@@ -84,7 +126,7 @@ def create_partial_conv_flow(config):
     flow_layers = get_flow_layers(config.size, config.c, vardeq=True, num_layers=8, linear=False, partial_conv=True)
 
     flow_model = ImageFlow(flow_layers, config=config)
-    sample_shape_factor = torch.tensor([1, 1, 1, 1])
+    sample_shape_factor = (1, 1, 1, 1)
     return flow_model, sample_shape_factor
 
 
@@ -94,51 +136,56 @@ def create_multiscale_flow(config):
     flow_layers = []
 
     # Vardeq, 2 Coupling
-    vardeq_layers = [CouplingLayer(network=GatedConvNet(c_in=2*config.c, c_out=2*config.c, c_hidden=16),
-                                   mask=create_checkerboard_mask(h=config.size, w=config.size, invert=(i % 2 == 1)),
-                                   c_in=1*config.c) for i in range(4)]
-    flow_layers += [VariationalDequantization(vardeq_layers)]
-
-    flow_layers += [CouplingLayer(network=GatedConvNet(c_in=1*config.c, c_hidden=32),
-                                  mask=create_checkerboard_mask(h=config.size, w=config.size, invert=(i % 2 == 1)),
-                                  c_in=1*config.c) for i in range(2)]
+    flow_layers += [VariationalDequantization(make_vardeq_layers(config.c, config.size))]
+    flow_layers += make_coupling_stack(c_in=1*config.c, c_hidden=32, n=2, size=config.size)
 
     # Squeeze, 2 Coupling
     flow_layers += [SqueezeFlow()]
-    for i in range(2):
-        flow_layers += [CouplingLayer(network=GatedConvNet(c_in=4*config.c, c_hidden=48),
-                                      mask=create_channel_mask(c_in=4*config.c, invert=(i % 2 == 1)),
-                                      c_in=4*config.c)]
+    flow_layers += make_coupling_stack(c_in=4*config.c, c_hidden=48, n=2)
 
     # Split (,Squeeze?), 4 Coupling
     flow_layers.append(SplitFlow(config=config))
 
     if squeeze_twice:
         flow_layers.append(SqueezeFlow())
-        flow_layers += [CouplingLayer(network=GatedConvNet(c_in=8*config.c, c_hidden=64),
-                                      mask=create_channel_mask(c_in=8*config.c, invert=(i % 2 == 1)),
-                                      c_in=8*config.c) for i in range(4)]
+        flow_layers += make_coupling_stack(c_in=8*config.c, c_hidden=64, n=4)
 
-        sample_shape_factor = torch.tensor([1, 8, 0.25, 0.25])
+        sample_shape_factor = (1, 8, 0.25, 0.25)
 
     else:
-        flow_layers += [CouplingLayer(network=GatedConvNet(c_in=2*config.c, c_hidden=64),
-                                      mask=create_channel_mask(c_in=2*config.c, invert=(i % 2 == 1)),
-                                      c_in=2*config.c) for i in range(4)]
+        flow_layers += make_coupling_stack(c_in=2*config.c, c_hidden=64, n=4)
 
-        sample_shape_factor = torch.tensor([1, 2, 0.5, 0.5])
+        sample_shape_factor = (1, 2, 0.5, 0.5)
 
     flow_model = ImageFlow(flow_layers, config=config)
     return flow_model, sample_shape_factor
 
 
+_FLOW_FACTORIES = {
+    "simple": create_simple_flow,
+    "vardeq": create_vardeq_flow,
+    "long": create_long_flow,
+    "linear": create_linear_flow,
+    "conv1x1": create_conv1x1_flow,
+    "partial_conv": create_partial_conv_flow,
+    "multiscale": create_multiscale_flow,
+}
+
+
 def create_flow(config):
-    create_flow_func = eval(f"create_{config.model_name}_flow")
     try:
-        net, sample_shape_factor = create_flow_func(config=config)
-    except NameError:
+        create_flow_func = _FLOW_FACTORIES[config.model_name]
+    except KeyError:
         raise NameError(f"Unknown model: {config.model_name}")
-
-    net = net.to(device=config.device)
+    net, sample_shape_factor = create_flow_func(config=config)
+
+    # channels_last routes every conv through cuDNN's NHWC kernels (masks are moved in one copy, see ImageFlow._apply)
+    net = net.to(device=config.device, memory_format=torch.channels_last)
+    if config.compile:
+        # Only the coupling networks are compiled: the flows around them stay eager (Lightning hooks, nan/inf checks),
+        # and CUDA graphs are left to ImageFlow.sample
+        for module in net.modules():
+            if isinstance(module, CouplingLayer):
+                module.network.compile(mode="max-autotune-no-cudagraphs")
     print(f"Done Creating Network! (model: {config.model_name})")
     return net, sample_shape_factor
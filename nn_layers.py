@@ -4,6 +4,24 @@ import torch.nn.functional as F
 from partialconv.models.partialconv2d import PartialConv2d
 
 
+@torch.jit.script
+def gated_residual(x: torch.Tensor, out: torch.Tensor) -> torch.Tensor:
+    """
+    Residual gate x + val * sigmoid(gate), scripted so the elementwise tail runs as one fused kernel.
+    out holds [val, gate] along dim 1, so the split index is the channel count of x.
+    """
+    c = x.size(1)
+    return torch.addcmul(x, out.narrow(1, 0, c), torch.sigmoid(out.narrow(1, c, c)))
+
+
+@torch.jit.script
+def concat_elu(x: torch.Tensor) -> torch.Tensor:
+    """
+    [elu(x), elu(-x)] along the channels, scripted so both ELUs and the concat fuse into one kernel
+    """
+    return torch.cat((F.elu(x), F.elu(-x)), dim=1)
+
+
 class ConcatELU(nn.Module):
     """
     Activation function that applies ELU in both direction (inverted and plain).
@@ -11,7 +29,7 @@ class ConcatELU(nn.Module):
     """
 
     def forward(self, x):
-        return torch.cat([F.elu(x), F.elu(-x)], dim=1)
+        return concat_elu(x)
 
 
 class LayerNormChannels(nn.Module):
@@ -23,13 +41,22 @@ class LayerNormChannels(nn.Module):
             c_in - Number of channels of the input
         """
         super().__init__()
+        # Kept as a submodule (used for its parameters only) so checkpoints stay compatible
         self.layer_norm = nn.LayerNorm(c_in)
 
     def forward(self, x):
-        x = x.permute(0, 2, 3, 1)
-        x = self.layer_norm(x)
-        x = x.permute(0, 3, 1, 2)
-        return x
+        ln = self.layer_norm
+        if x.is_contiguous(memory_format=torch.channels_last):
+            # NHWC storage: the permutes are free views and layer_norm reduces over the contiguous last dim
+            x = F.layer_norm(x.permute(0, 2, 3, 1), ln.normalized_shape, ln.weight, ln.bias, ln.eps)
+            return x.permute(0, 3, 1, 2)
+        # NCHW storage: normalize over dim 1 directly instead of materializing permuted copies (in fp32, as autocast
+        # does for F.layer_norm)
+        x = x.float()
+        u = x.mean(1, keepdim=True)
+        s = (x - u).pow(2).mean(1, keepdim=True)
+        x = (x - u) * torch.rsqrt(s + ln.eps)
+        return ln.weight.view(1, -1, 1, 1) * x + ln.bias.view(1, -1, 1, 1)
 
 
 ############################## GatedConvNet ##############################
@@ -54,8 +81,7 @@ class GatedConv(nn.Module):
 
     def forward(self, x):
         out = self.net(x)
-        val, gate = out.chunk(2, dim=1)
-        return x + val * torch.sigmoid(gate)
+        return gated_residual(x, out)
 
 
 class GatedConvNet(nn.Module):
@@ -85,6 +111,8 @@ class GatedConvNet(nn.Module):
         self.nn[-1].bias.data.zero_()
 
     def forward(self, x):
+        # Convert once at the module boundary, the layers below preserve the memory format
+        x = x.contiguous(memory_format=torch.channels_last)
         return self.nn(x)
 
 
@@ -103,8 +131,7 @@ class GatedLinear(nn.Module):
 
     def forward(self, x):
         out = self.net(x)
-        val, gate = out.chunk(2, dim=1)
-        return x + val * torch.sigmoid(gate)
+        return gated_residual(x, out)
 
 
 class GatedLinearNet(nn.Module):
@@ -134,7 +161,62 @@ class GatedLinearNet(nn.Module):
     def forward(self, x):
         b, c, h, w = x.shape
 
-        out = torch.flatten(x, start_dim=1)
+        # The masked input may arrive channels_last, flattening must follow the (c, h, w) order
+        x = x.contiguous()
+        out = x.view(b, -1)
         out = self.nn(out)
-        out = torch.reshape(out, [b, 2*c, h, w])
+        out = out.view(b, 2*c, h, w)
         return out
+
+
+############################## GatedConv1x1Net ##############################
+
+
+class GatedConv1x1(nn.Module):
+
+    def __init__(self, c_in):
+        """
+        Per-pixel version of GatedLinear: 1x1 convolutions over the channels instead of dense layers over the image
+        Inputs:
+            c_in - Number of channels of the input
+        """
+        super().__init__()
+        self.net = nn.Sequential(
+            nn.Conv2d(c_in, c_in, kernel_size=1),
+            ConcatELU(),
+            nn.Conv2d(2 * c_in, 2 * c_in, kernel_size=1)
+        )
+
+    def forward(self, x):
+        out = self.net(x)
+        return gated_residual(x, out)
+
+
+class GatedConv1x1Net(nn.Module):
+
+    def __init__(self, c_in, c_hidden=32, num_layers=3):
+        """
+        Alternative to GatedLinearNet with O(C^2) instead of O((C*H*W)^2) weights.
+        The 3x3 input and output convolutions (as in GatedConvNet) mix neighbouring pixels, so a checkerboard
+        coupling still conditions on the unmasked pixels; the gated blocks in between are per-pixel 1x1 convolutions.
+        Inputs:
+            c_in - Number of input channels
+            c_hidden - Number of hidden dimensions to use within the network
+            num_layers - Number of gated ResNet blocks to apply
+        """
+        super().__init__()
+        layers = []
+        layers += [nn.Conv2d(c_in, c_hidden, kernel_size=3, padding=1)]
+        for layer_index in range(num_layers):
+            layers += [GatedConv1x1(c_hidden),
+                       LayerNormChannels(c_hidden)]
+        layers += [ConcatELU(),
+                   nn.Conv2d(2 * c_hidden, 2 * c_in, kernel_size=3, padding=1)]
+        self.nn = nn.Sequential(*layers)
+
+        self.nn[-1].weight.data.zero_()
+        self.nn[-1].bias.data.zero_()
+
+    def forward(self, x):
+        x = x.contiguous(memory_format=torch.channels_last)
+        return self.nn(x)
@@ -1,4 +1,5 @@
 import os
+import functools
 import torch
 import torchvision
 import numpy as np
@@ -17,10 +18,10 @@ def imgs_to_plt(imgs, title=None, row_size=4):
     nrow = min(num_imgs, row_size)
     ncol = int(math.ceil(num_imgs/nrow))
     imgs = torchvision.utils.make_grid(imgs, nrow=nrow, pad_value=128 if is_int else 0.5)
-    np_imgs = imgs.cpu().numpy()
+    np_imgs = imgs.permute(1, 2, 0).contiguous().cpu().numpy()
     # Plot the grid
     plt.figure(figsize=(1.5*nrow, 1.5*ncol))
-    plt.imshow(np.transpose(np_imgs, (1, 2, 0)), interpolation='nearest')
+    plt.imshow(np_imgs, interpolation='nearest')
     plt.axis('off')
     if title is not None:
         plt.title(title)
@@ -28,19 +29,28 @@ def imgs_to_plt(imgs, title=None, row_size=4):
 
 def sample_save_show(flow, img_shape, sample_shape_factor, config):
     # sample
-    batched_img_shape = torch.cat((torch.tensor([config.num_samples]), torch.tensor(img_shape)))
-    sample_shape = torch.Size((batched_img_shape * sample_shape_factor).int())
+    batched_img_shape = (config.num_samples, *img_shape)
+    sample_shape = torch.Size(int(ns * sf) for ns, sf in zip(batched_img_shape, sample_shape_factor))
     samples = flow.sample(sample_shape=sample_shape).cpu()
+    row_size = math.ceil(math.sqrt(config.num_samples))
+
+    # save only: write the grid directly, without going through matplotlib
+    if not config.show_samples:
+        if config.save_samples:
+            # samples are quantized to [0, 255], save_image expects floats in [0, 1]
+            torchvision.utils.save_image(samples.float() / 255, config.results_filepath,
+                                         nrow=min(samples.shape[0], row_size), pad_value=0.5)
+            print(f"Figure saved to {config.results_filepath}")
+        return
 
     # samples to plt
-    imgs_to_plt(imgs=samples, row_size=math.ceil(math.sqrt(config.num_samples)))
+    imgs_to_plt(imgs=samples, row_size=row_size)
     # save
     if config.save_samples:
         plt.savefig(config.results_filepath)
         print(f"Figure saved to {config.results_filepath}")
     # show
-    if config.show_samples:
-        plt.show()
+    plt.show()
     plt.close()
 
 
@@ -61,21 +71,25 @@ def plot_hist(x):
 
 
 # Masks for Coupling Layer
+# Masks only depend on their arguments, so they are built once and shared (do not modify them in-place)
 
 
+@functools.lru_cache(maxsize=None)
 def create_checkerboard_mask(h, w, invert=False):
-    h_range, w_range = torch.arange(h, dtype=torch.int32), torch.arange(w, dtype=torch.int32)
-    hh, ww = torch.meshgrid(h_range, w_range, indexing='ij')
-    mask = torch.fmod(hh + ww, 2)
-    mask = mask.to(torch.float32).view(1, 1, h, w)
+    # Parity of h_idx + w_idx is the lowest bit of h_idx ^ w_idx (broadcast, no meshgrid)
+    h_idx = torch.arange(h, dtype=torch.int32).view(h, 1)
+    w_idx = torch.arange(w, dtype=torch.int32).view(1, w)
+    mask = (h_idx ^ w_idx) & 1
     if invert:
-        mask = 1 - mask
+        mask = mask ^ 1
+    mask = mask.to(torch.float32).view(1, 1, h, w)
     return mask
 
 
+@functools.lru_cache(maxsize=None)
 def create_channel_mask(c_in, invert=False):
-    mask = torch.cat([torch.ones(c_in//2, dtype=torch.float32),
-                      torch.zeros(c_in-c_in//2, dtype=torch.float32)])
+    mask = torch.zeros(c_in, dtype=torch.float32)
+    mask[:c_in//2] = 1.0
     mask = mask.view(1, c_in, 1, 1)
     if invert:
         mask = 1 - mask
@@ -13,6 +13,7 @@ def train_flow(flow, train_loader, val_loader, test_loader, config):
     logger = WandbLogger(project="Normalizing_Flows")
     trainer = pl.Trainer(logger=logger,
                          gpus=1,
+                         precision="bf16" if config.amp else 32,
                          max_epochs=config.epochs,
                          gradient_clip_val=1.0,
                          callbacks=[ModelCheckpoint(save_weights_only=True, mode="min", monitor="val_bpd"),
@@ -37,7 +38,9 @@ def load_flow(flow, config):
     print(f"Loading model from {config.trained_filepath}...")
     assert os.path.isfile(config.trained_filepath), f"Model file {config.trained_filepath} not found"
     ckpt = torch.load(config.trained_filepath)
-    flow.load_state_dict(ckpt['state_dict'])
+    # Masks are no longer saved (non-persistent buffers), drop them from older checkpoints
+    state_dict = {k: v for k, v in ckpt['state_dict'].items() if not k.endswith('.mask')}
+    flow.load_state_dict(state_dict)
     result = ckpt.get("result", None)
     assert result is not None
 